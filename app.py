@@ -1,8 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, make_response
 from flask_sqlalchemy import SQLAlchemy
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import os
 import re
 import nltk
@@ -12,6 +12,9 @@ from sklearn.metrics.pairwise import cosine_similarity
 import random
 import string
 import warnings
+import threading
+import time
+import math
 warnings.filterwarnings('ignore')
 
 app = Flask(__name__)
@@ -286,6 +289,154 @@ def login_required(func):
         return func(*args, **kwargs)
     return wrapper
 
+# ------------------ RATE LIMITING & ADMISSION CONTROL ------------------
+class MemoryRateLimitStore:
+    """In-process token buckets and rejection counters (single worker)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counters = {}
+
+    def take(self, key, capacity, refill_rate):
+        """Take one token; returns (allowed, seconds until next token)"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * refill_rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return True, 0
+            self.buckets[key] = (tokens, now)
+            return False, (1 - tokens) / refill_rate
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def counts(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class RedisRateLimitStore:
+    """Shared token buckets in Redis so all workers enforce the same budget"""
+    TAKE_SCRIPT = """
+    -- Redis < 5 only allows writes after TIME with effects replication
+    redis.replicate_commands()
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+    local tokens = tonumber(state[1]) or capacity
+    local last = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis
+        # Short timeouts so an unreachable Redis costs milliseconds, not the OS connect timeout
+        self.client = redis.Redis.from_url(url, socket_connect_timeout=0.1, socket_timeout=0.1)
+        self.client.ping()
+        self.take_script = self.client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, capacity, refill_rate):
+        allowed, tokens = self.take_script(keys=[f"ratelimit:{key}"],
+                                           args=[capacity, refill_rate])
+        if int(allowed):
+            return True, 0
+        return False, (1 - float(tokens)) / refill_rate
+
+    def incr(self, name):
+        try:
+            self.client.hincrby("ratelimit:rejected", name, 1)
+        except Exception as e:
+            print(f"Rate limit counter error: {e}")
+
+    def counts(self):
+        try:
+            return {k.decode(): int(v) for k, v in self.client.hgetall("ratelimit:rejected").items()}
+        except Exception as e:
+            print(f"Rate limit counter error: {e}")
+            return {}
+
+
+def create_rate_limit_store():
+    """Use Redis when RATELIMIT_STORAGE_URL is set, otherwise keep state in-process"""
+    storage_url = os.environ.get("RATELIMIT_STORAGE_URL")
+    if not storage_url:
+        return MemoryRateLimitStore()
+    try:
+        return RedisRateLimitStore(storage_url)
+    except Exception as e:
+        # A silent per-worker fallback would multiply every budget by the worker count
+        raise RuntimeError(f"RATELIMIT_STORAGE_URL is set but Redis is not usable: {e}") from e
+
+rate_limit_store = create_rate_limit_store()
+
+# Expensive work (chart rendering, full table exports) shares one concurrency cap per worker;
+# requests wait up to HEAVY_WAIT seconds for a slot before being turned away
+HEAVY_CONCURRENCY = int(os.environ.get("HEAVY_CONCURRENCY", 2))
+HEAVY_WAIT = float(os.environ.get("HEAVY_WAIT", 2))
+heavy_semaphore = threading.BoundedSemaphore(HEAVY_CONCURRENCY)
+
+def limit_exceeded(message, status, retry_after):
+    """429/503 response with Retry-After; JSON callers (chat) get a 'reply', browsers get a page"""
+    retry_after = max(1, math.ceil(retry_after))
+    if request.is_json:
+        response = jsonify({'reply': message, 'error': message, 'retry_after': retry_after})
+    else:
+        response = make_response(render_template('busy.html', message=message, retry_after=retry_after))
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limit(name, limit, period):
+    """Token bucket of `limit` requests per `period` seconds per logged-in user.
+    Must sit under login_required/admin_required so session['user_id'] is set."""
+    refill_rate = limit / period
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                allowed, retry_after = rate_limit_store.take(f"{name}:user:{session['user_id']}",
+                                                             limit, refill_rate)
+            except Exception as e:
+                # Never take the route down because the shared store is unreachable
+                print(f"Rate limit error: {e}")
+                allowed, retry_after = True, 0
+            if not allowed:
+                rate_limit_store.incr(f"{name}:rate_limited")
+                return limit_exceeded("Too many requests. Please slow down and try again shortly.",
+                                      429, retry_after)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def concurrency_limit(name, retry_after=2):
+    """Wait briefly for a heavy-work slot, then reject with 503 instead of queuing indefinitely"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not heavy_semaphore.acquire(timeout=HEAVY_WAIT):
+                rate_limit_store.incr(f"{name}:overloaded")
+                return limit_exceeded("Server is busy. Please try again in a few seconds.",
+                                      503, retry_after)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                heavy_semaphore.release()
+        return wrapper
+    return decorator
+
 # ------------------ ROUTES ------------------
 @app.route('/', methods=['GET', 'POST'])
 def register():
@@ -433,6 +584,8 @@ def personhealth():
 
 @app.route('/progress')
 @login_required
+@concurrency_limit('progress')
+@rate_limit('progress', limit=5, period=60)
 def progress():
     user_id = session.get('user_id')
     user_data = HealthInfo.query.filter_by(user_id=user_id).all()
@@ -451,25 +604,27 @@ def progress():
     entries = list(range(1, len(bmis) + 1))
 
     # ✅ Plot BMI Progress with Color Zones
+    # Figure API instead of pyplot: no global state, so concurrent renders don't collide
     import matplotlib.patches as mpatches
-    plt.figure(figsize=(10, 6))
-    plt.title("Your BMI Progress Over Time", fontsize=14, fontweight='bold')
-    plt.xlabel("Entry Number", fontweight='bold')
-    plt.ylabel("BMI Value", fontweight='bold')
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.set_title("Your BMI Progress Over Time", fontsize=14, fontweight='bold')
+    ax.set_xlabel("Entry Number", fontweight='bold')
+    ax.set_ylabel("BMI Value", fontweight='bold')
 
     # Draw BMI categories (background color bands)
-    plt.axhspan(0, 18.4, facecolor='#ADD8E6', alpha=0.3, label='Underweight (<18.5)')
-    plt.axhspan(18.5, 24.9, facecolor='#90EE90', alpha=0.3, label='Normal (18.5–24.9)')
-    plt.axhspan(25, 29.9, facecolor='#FFD580', alpha=0.3, label='Overweight (25–29.9)')
-    plt.axhspan(30, 100, facecolor='#FF7F7F', alpha=0.3, label='Obese (30+)')
+    ax.axhspan(0, 18.4, facecolor='#ADD8E6', alpha=0.3, label='Underweight (<18.5)')
+    ax.axhspan(18.5, 24.9, facecolor='#90EE90', alpha=0.3, label='Normal (18.5–24.9)')
+    ax.axhspan(25, 29.9, facecolor='#FFD580', alpha=0.3, label='Overweight (25–29.9)')
+    ax.axhspan(30, 100, facecolor='#FF7F7F', alpha=0.3, label='Obese (30+)')
 
     # Plot user's BMI line
-    plt.plot(entries, bmis, marker='o', color='blue', linewidth=2, label="Your BMI", markersize=8)
-    plt.grid(True, linestyle="--", alpha=0.6)
+    ax.plot(entries, bmis, marker='o', color='blue', linewidth=2, label="Your BMI", markersize=8)
+    ax.grid(True, linestyle="--", alpha=0.6)
 
     # Add value annotations on points
     for i, (x, y) in enumerate(zip(entries, bmis)):
-        plt.annotate(f'{y}', (x, y), textcoords="offset points", xytext=(0,10), ha='center', fontsize=9)
+        ax.annotate(f'{y}', (x, y), textcoords="offset points", xytext=(0,10), ha='center', fontsize=9)
 
     # Add legend
     handles = [
@@ -478,12 +633,11 @@ def progress():
         mpatches.Patch(color='#FFD580', label='Overweight (25–29.9)'),
         mpatches.Patch(color='#FF7F7F', label='Obese (30+)'),
     ]
-    plt.legend(handles=handles, loc="upper left", fontsize=9)
+    ax.legend(handles=handles, loc="upper left", fontsize=9)
 
     # Save graph
     img_path = os.path.join("static", f"progress_{user_id}.png")
-    plt.savefig(img_path, bbox_inches='tight', dpi=100)
-    plt.close()
+    fig.savefig(img_path, bbox_inches='tight', dpi=100)
 
     # ✅ Table data
     progress_data = [
@@ -511,6 +665,7 @@ def chatbot_page():
 
 @app.route("/chat", methods=["POST"])
 @login_required
+@rate_limit('chat', limit=30, period=60)
 def chat():
     try:
         user_msg = request.json["message"]
@@ -573,6 +728,8 @@ def admin_dashboard():
 
 @app.route('/admin/view-data')
 @admin_required
+@concurrency_limit('admin_view_data')
+@rate_limit('admin_view_data', limit=3, period=60)
 def admin_view_data():
     """🔒 SECURE: View all database data - Admin only"""
     try:
@@ -655,6 +812,7 @@ def live_stats():
             'total_users': total_users,
             'total_health_records': total_health,
             'recent_users': recent_users_list,
+            'rate_limit_rejections': rate_limit_store.counts(),
             'database_url': app.config['SQLALCHEMY_DATABASE_URI'][:50] + '...'  # Hide full URL
         })
         